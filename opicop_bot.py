@@ -1,75 +1,239 @@
 import os
 import time
 import json
+import heapq
+import queue
+import itertools
 import threading
 import requests
-from datetime import datetime, date
+import numpy as np
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ============================================================
 # CONFIG
 # ============================================================
 OPINION_TRADE_URL = "https://openapi.opinion.trade/openapi/trade/user/{wallet}"
 OPINION_POSITIONS_URL = "https://openapi.opinion.trade/openapi/positions/user/{wallet}"
 POLL_SECONDS = 5
+CHAIN_POLL_SECONDS = 1
+CHAIN_MAX_BLOCK_RANGE = 500
+CHAIN_AMOUNT_DECIMALS = 18
+# keccak("OrderFilled(bytes32,address,address,uint256,uint256,uint256,uint256,uint256)")
+ORDER_FILLED_TOPIC = "0xd0a08e8c493f9c94f29311604c9de1b4e8c8d4c06bd0c789af57f2d65bfec0f6"
+# Safe isOwner(address)
+SAFE_IS_OWNER_SELECTOR = "0x2f54bf6e"
+SEEN_TX_LIMIT = 2000
+PORTFOLIO_REFRESH_SECONDS = 300
+PORTFOLIO_TOP_MARKETS = 10
 HEARTBEAT_SECONDS = 3600
+CACHE_EXPIRY_SECONDS = 60
+SUMMARY_RETRY_SECONDS = 300
+CHAT_STEP_TTL = 600
+SCHEDULER_MAX_SLEEP = 60
+DEFAULT_TIMEZONE = "Asia/Ho_Chi_Minh"
 DAILY_FILE = "daily_summary.json"
 STATE_FILE = "state.json"
 TELEGRAM_CHAT_ID = "508551859"
 TG_BASE = "https://api.telegram.org/bot{token}/{method}"
 
 
+# ============================================================
+# RECORDS
+# ============================================================
+
+def to_float(v):
+    """float(v or 0), hoặc None nếu API trả giá trị không parse được."""
+    try:
+        return float(v or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_int(v):
+    try:
+        return int(v or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def pick_id(raw):
+    for k in ["txHash", "tradeNo", "createdAt", "id"]:
+        v = raw.get(k)
+        if v:
+            return str(v)
+    return str(raw)
+
+
+class Trade:
+    """Một trade đã decode từ /trade/user/{wallet}, parse đúng 1 lần."""
+
+    __slots__ = (
+        "trade_id", "tx_hash", "side", "outcome_side",
+        "market_id", "market_title", "root_market_id", "root_market_title",
+        "price", "amount", "created_at",
+    )
+
+    def __init__(self, trade_id, tx_hash="", side="", outcome_side="",
+                 market_id="", market_title="", root_market_id="", root_market_title="",
+                 price=0.0, amount=0.0, created_at=0):
+        self.trade_id = trade_id
+        self.tx_hash = tx_hash
+        self.side = side
+        self.outcome_side = outcome_side
+        self.market_id = market_id
+        self.market_title = market_title
+        self.root_market_id = root_market_id
+        self.root_market_title = root_market_title
+        self.price = price
+        self.amount = amount
+        self.created_at = created_at
+
+    @classmethod
+    def from_dict(cls, raw):
+        market_id = str(raw.get("marketId") or "")
+        return cls(
+            trade_id=pick_id(raw),
+            tx_hash=str(raw.get("txHash") or ""),
+            side=str(raw.get("side") or "").upper(),
+            outcome_side=str(raw.get("outcomeSide") or ""),
+            market_id=market_id,
+            market_title=raw.get("marketTitle") or "",
+            root_market_id=str(raw.get("rootMarketId") or "") or market_id,
+            root_market_title=raw.get("rootMarketTitle") or "",
+            price=to_float(raw.get("price")),
+            amount=to_float(raw.get("amount")),
+            created_at=to_int(raw.get("createdAt")),
+        )
+
+    @property
+    def title(self):
+        return self.root_market_title or self.market_title
+
+    @property
+    def is_multi(self):
+        # Multi-market: rootMarketId khác marketId
+        return bool(self.root_market_id and self.market_id and self.root_market_id != self.market_id)
+
+    @property
+    def sub_title(self):
+        """Tên outcome cụ thể của multi-market, rỗng nếu là single market."""
+        if self.is_multi and self.market_title and self.market_title != self.title:
+            return self.market_title
+        return ""
+
+
+class Position:
+    """Một position đã decode từ /positions/user/{wallet}."""
+
+    __slots__ = (
+        "market_id", "market_title", "root_market_id", "root_market_title", "outcome_side",
+        "shares", "value", "avg_price", "pnl", "pnl_pct",
+    )
+
+    def __init__(self, market_id="", market_title="", root_market_id="", root_market_title="",
+                 outcome_side="", shares=0.0, value=0.0, avg_price=0.0, pnl=0.0, pnl_pct=0.0):
+        self.market_id = market_id
+        self.market_title = market_title
+        self.root_market_id = root_market_id
+        self.root_market_title = root_market_title
+        self.outcome_side = outcome_side
+        self.shares = shares
+        self.value = value
+        self.avg_price = avg_price
+        self.pnl = pnl
+        self.pnl_pct = pnl_pct
+
+    @classmethod
+    def from_dict(cls, raw):
+        market_id = str(raw.get("marketId") or "")
+        pnl_pct = to_float(raw.get("unrealizedPnlPercent"))
+        return cls(
+            market_id=market_id,
+            market_title=raw.get("marketTitle") or "",
+            root_market_id=str(raw.get("rootMarketId") or "") or market_id,
+            root_market_title=raw.get("rootMarketTitle") or "",
+            outcome_side=str(raw.get("outcomeSide") or ""),
+            shares=to_float(raw.get("sharesOwned")),
+            value=to_float(raw.get("currentValueInQuoteToken")),
+            avg_price=to_float(raw.get("avgEntryPrice")),
+            pnl=to_float(raw.get("unrealizedPnl")),
+            pnl_pct=pnl_pct * 100 if pnl_pct is not None else None,
+        )
+
+    @property
+    def title(self):
+        return self.root_market_title or self.market_title or f"Market {self.market_id or '?'}"
+
+
+def decode_json(resp):
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+
+def parse_list(data, record_cls):
+    """result.list -> list record, bỏ qua entry không phải dict."""
+    result = data.get("result") if isinstance(data, dict) else None
+    items = (result or {}).get("list") if isinstance(result, dict) else None
+    if not isinstance(items, list):
+        return []
+    return [record_cls.from_dict(x) for x in items if isinstance(x, dict)]
+
+
+def opinion_get(api_key, url, record_cls, timeout=30):
+    resp = requests.get(url, headers={"apikey": api_key}, timeout=timeout)
+    resp.raise_for_status()
+    return parse_list(decode_json(resp), record_cls)
+
+
+def fmt_num(v, fmt, scale=1, prefix="", suffix=""):
+    if v is None:
+        return "?"
+    return f"{prefix}{format(v * scale, fmt)}{suffix}"
+
+
+def fmt_signed(v, fmt, prefix="", suffix=""):
+    if v is None:
+        return "?"
+    sign = "+" if v >= 0 else "-"
+    return f"{sign}{prefix}{format(abs(v), fmt)}{suffix}"
+
+
 # ============================================================
 # FETCH POSITIONS
 # ============================================================
 
 def fetch_positions(api_key: str, eoa: str) -> str:
     url = OPINION_POSITIONS_URL.format(wallet=eoa)
-    headers = {"apikey": api_key}
 
     try:
-        resp = requests.get(url, headers=headers, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        result = data.get("result", {})
-        positions = result.get("list", [])
+        positions = opinion_get(api_key, url, Position)
+        PORTFOLIO.update_wallet(eoa, positions)
 
         if not positions:
             return "Ví không có position nào đang mở."
 
         lines = [f"Positions ({len(positions)} vị thế)\n"]
         for i, p in enumerate(positions, 1):
-            root_market = p.get("rootMarketTitle") or p.get("marketTitle") or f"Market {p.get('marketId', '?')}"
-            sub_market = p.get("marketTitle") or ""
-            outcome = "YES" if p.get("outcomeSide") == 1 else "NO"
-
-            try:
-                shares_str = f"{float(p.get('sharesOwned') or 0):.4f}"
-            except Exception:
-                shares_str = "?"
-
-            try:
-                value_str = f"${float(p.get('currentValueInQuoteToken') or 0):.4f}"
-            except Exception:
-                value_str = "?"
-
-            try:
-                avg_cost_str = f"{float(p.get('avgEntryPrice') or 0):.4f}c"
-            except Exception:
-                avg_cost_str = "?"
-
-            try:
-                pnl_float = float(p.get("unrealizedPnl") or 0)
-                pnl_pct_float = float(p.get("unrealizedPnlPercent") or 0) * 100
-                pnl_str = f"+${pnl_float:.4f}" if pnl_float >= 0 else f"-${abs(pnl_float):.4f}"
-                pnl_pct_str = f"+{pnl_pct_float:.1f}%" if pnl_pct_float >= 0 else f"{pnl_pct_float:.1f}%"
-            except Exception:
-                pnl_str = "?"
-                pnl_pct_str = "?"
+            root_market = p.title
+            outcome = "YES" if p.outcome_side == "1" else "NO"
+            shares_str = fmt_num(p.shares, ".4f")
+            value_str = fmt_num(p.value, ".4f", prefix="$")
+            avg_cost_str = fmt_num(p.avg_price, ".4f", suffix="c")
+            pnl_str = fmt_signed(p.pnl, ".4f", prefix="$")
+            pnl_pct_str = fmt_signed(p.pnl_pct, ".1f", suffix="%")
 
             lines.append(f"{i}. *{root_market}*")
-            if sub_market and sub_market != root_market:
-                lines.append(f"   {sub_market}")
+            if p.market_title and p.market_title != root_market:
+                lines.append(f"   {p.market_title}")
             lines.append(f"   {outcome} | Shares: {shares_str} | Value: {value_str}")
             lines.append(f"   Avg Cost: {avg_cost_str} | PnL: {pnl_str} ({pnl_pct_str})\n")
 
@@ -86,54 +250,34 @@ def fetch_positions(api_key: str, eoa: str) -> str:
 
 def fetch_history(api_key: str, eoa: str) -> str:
     url = OPINION_TRADE_URL.format(wallet=eoa)
-    headers = {"apikey": api_key}
 
     try:
-        resp = requests.get(url, headers=headers, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        result = data.get("result", {})
-        trades = result.get("list") or []
+        trades = opinion_get(api_key, url, Trade)
 
-        if not isinstance(trades, list) or not trades:
+        if not trades:
             return "Ví chưa có trade nào."
 
         trades = trades[:10]
 
         lines = ["*10 Trade gần nhất*\n"]
         for i, t in enumerate(trades, 1):
-            side = str(t.get("side", "")).upper()
-            outcome = "YES" if str(t.get("outcomeSide", "")) == "1" else "NO"
-            root_market = t.get("rootMarketTitle") or t.get("marketTitle") or "?"
-            root_market_id = t.get("rootMarketId") or t.get("marketId") or ""
-            market_id = t.get("marketId") or ""
-            sub_market_title = t.get("marketTitle") or ""
-            is_multi = root_market_id and market_id and str(root_market_id) != str(market_id)
-
-            try:
-                price_str = f"{float(t.get('price') or 0) * 100:.1f}c"
-            except Exception:
-                price_str = "?"
-
-            try:
-                usd_str = f"${float(t.get('amount') or 0):.2f}"
-            except Exception:
-                usd_str = "?"
+            outcome = "YES" if t.outcome_side == "1" else "NO"
+            price_str = fmt_num(t.price, ".1f", scale=100, suffix="c")
+            usd_str = fmt_num(t.amount, ".2f", prefix="$")
 
             try:
-                ts = int(t.get("createdAt") or 0)
-                time_str = datetime.fromtimestamp(ts).strftime("%d/%m %H:%M")
+                time_str = datetime.fromtimestamp(t.created_at).strftime("%d/%m %H:%M")
             except Exception:
                 time_str = "?"
 
-            if is_multi and sub_market_title and sub_market_title != root_market:
-                action_str = f"*{side} {outcome} ({sub_market_title})* for {usd_str} at {price_str}"
+            if t.sub_title:
+                action_str = f"*{t.side} {outcome} ({t.sub_title})* for {usd_str} at {price_str}"
             else:
-                action_str = f"*{side} {outcome}* for {usd_str} at {price_str}"
+                action_str = f"*{t.side} {outcome}* for {usd_str} at {price_str}"
 
             lines.append(
                 f"{i}. {action_str}\n"
-                f"   {root_market[:50]}\n"
+                f"   {(t.title or '?')[:50]}\n"
                 f"   {time_str}\n"
             )
 
@@ -144,6 +288,224 @@ def fetch_history(api_key: str, eoa: str) -> str:
         return "Không lấy được lịch sử trade. Thử lại sau."
 
 
+# ============================================================
+# PORTFOLIO
+# ============================================================
+
+class PortfolioTable:
+    """Positions của mọi ví đang theo dõi, lưu dạng cột NumPy.
+
+    Mỗi ví giữ 1 block cột riêng; snapshot mới của 1 ví chỉ thay block của
+    ví đó (và bỏ qua nếu không đổi). Bảng gộp được concatenate lại khi query.
+    Cột: wallet, market (index vào `wallets`/`markets`), side (1 YES, 2 NO),
+    shares, value, avg_price, pnl.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wallets = []
+        self.wallet_index = {}
+        self.markets = []
+        self.market_index = {}
+        self.blocks = {}
+        self.signatures = {}
+        self.stale = set()
+        self.table = None
+
+    def _intern_wallet(self, wallet):
+        wallet = wallet.lower()
+        if wallet not in self.wallet_index:
+            self.wallet_index[wallet] = len(self.wallets)
+            self.wallets.append(wallet)
+        return self.wallet_index[wallet]
+
+    def _intern_market(self, p):
+        key = p.market_id or p.title
+        title = p.title
+        if p.market_title and p.market_title != title:
+            title = f"{title} ({p.market_title})"
+        if key not in self.market_index:
+            self.market_index[key] = len(self.markets)
+            self.markets.append(title)
+        return self.market_index[key]
+
+    def update_wallet(self, wallet, positions):
+        """Thay snapshot của 1 ví. Trả về True nếu có thay đổi."""
+        sig = tuple((p.market_id, p.outcome_side, p.shares, p.value, p.avg_price, p.pnl) for p in positions)
+        with self.lock:
+            w = self._intern_wallet(wallet)
+            self.stale.discard(w)
+            if self.signatures.get(w) == sig:
+                return False
+
+            n = len(positions)
+            nan = float("nan")
+            self.blocks[w] = {
+                "wallet": np.full(n, w, dtype=np.int32),
+                "market": np.fromiter((self._intern_market(p) for p in positions), dtype=np.int32, count=n),
+                "side": np.fromiter((int(p.outcome_side) if p.outcome_side in ("1", "2") else 0
+                                     for p in positions), dtype=np.int8, count=n),
+                "shares": np.array([nan if p.shares is None else p.shares for p in positions], dtype=np.float64),
+                "value": np.array([nan if p.value is None else p.value for p in positions], dtype=np.float64),
+                "avg_price": np.array([nan if p.avg_price is None else p.avg_price for p in positions], dtype=np.float64),
+                "pnl": np.array([nan if p.pnl is None else p.pnl for p in positions], dtype=np.float64),
+            }
+            self.signatures[w] = sig
+            self.table = None
+            return True
+
+    def remove_wallet(self, wallet):
+        with self.lock:
+            w = self.wallet_index.get(wallet.lower())
+            if w is not None and self.blocks.pop(w, None) is not None:
+                self.signatures.pop(w, None)
+                self.table = None
+
+    def mark_stale(self, wallet):
+        with self.lock:
+            self.stale.add(self._intern_wallet(wallet))
+
+    def needs_refresh(self, wallet):
+        w = self.wallet_index.get(wallet.lower())
+        return w is None or w not in self.blocks or w in self.stale
+
+    def columns(self, wallets=None):
+        """Bảng gộp (dict cột), chỉ gồm các ví trong `wallets` nếu có."""
+        with self.lock:
+            if self.table is None:
+                blocks = list(self.blocks.values())
+                if blocks:
+                    self.table = {k: np.concatenate([b[k] for b in blocks]) for k in blocks[0]}
+                else:
+                    self.table = {
+                        "wallet": np.empty(0, np.int32), "market": np.empty(0, np.int32),
+                        "side": np.empty(0, np.int8), "shares": np.empty(0), "value": np.empty(0),
+                        "avg_price": np.empty(0), "pnl": np.empty(0),
+                    }
+            table = self.table
+            if wallets is None:
+                return table
+            ids = [self.wallet_index[x.lower()] for x in wallets if x.lower() in self.wallet_index]
+        mask = np.isin(table["wallet"], ids)
+        return {k: v[mask] for k, v in table.items()}
+
+    def summary(self, wallets=None):
+        """Aggregate exposure / consensus / PnL bằng group-by vector hoá."""
+        t = self.columns(wallets)
+        value = np.nan_to_num(t["value"])
+        pnl = np.nan_to_num(t["pnl"])
+        shares = np.nan_to_num(t["shares"])
+        cost = np.nan_to_num(t["avg_price"]) * shares
+        wallet, market, side = t["wallet"], t["market"], t["side"]
+        n_wallets = max(len(self.wallets), 1)
+
+        # Exposure theo market
+        m_ids, m_inv = np.unique(market, return_inverse=True)
+        m_value = np.bincount(m_inv, weights=value, minlength=len(m_ids))
+        m_yes = np.bincount(m_inv, weights=value * (side == 1), minlength=len(m_ids))
+        m_no = np.bincount(m_inv, weights=value * (side == 2), minlength=len(m_ids))
+        m_pnl = np.bincount(m_inv, weights=pnl, minlength=len(m_ids))
+        # Số ví khác nhau mỗi market: unique cặp (market, wallet)
+        pair_market = np.unique(market.astype(np.int64) * n_wallets + wallet) // n_wallets
+        m_wallets = np.bincount(np.searchsorted(m_ids, pair_market), minlength=len(m_ids))
+        order = np.argsort(-m_value)
+        exposure = [
+            (self.markets[m_ids[i]], m_value[i], m_yes[i], m_no[i], m_pnl[i], int(m_wallets[i]))
+            for i in order
+        ]
+
+        # Consensus: market + side có >= 2 ví cùng giữ (bỏ side không rõ = 0)
+        known = side != 0
+        key = market[known].astype(np.int64) * 3 + side[known]
+        k_ids, k_count = np.unique(np.unique(key * n_wallets + wallet[known]) // n_wallets, return_counts=True)
+        k_inv = np.searchsorted(k_ids, key)
+        k_value = np.bincount(k_inv, weights=value[known], minlength=len(k_ids))
+        k_shares = np.bincount(k_inv, weights=shares[known], minlength=len(k_ids))
+        k_cost = np.bincount(k_inv, weights=cost[known], minlength=len(k_ids))
+        k_avg = np.divide(k_cost, k_shares, out=np.full(len(k_ids), np.nan), where=k_shares > 0)
+        consensus = [
+            (self.markets[k_ids[i] // 3], fmt_outcome(str(k_ids[i] % 3)), int(k_count[i]), k_value[i], k_avg[i])
+            for i in np.lexsort((-k_value, -k_count)) if k_count[i] >= 2
+        ]
+
+        # PnL theo ví
+        w_value = np.bincount(wallet, weights=value, minlength=n_wallets)
+        w_pnl = np.bincount(wallet, weights=pnl, minlength=n_wallets)
+        w_ids = np.unique(wallet)
+        per_wallet = [(self.wallets[w], w_value[w], w_pnl[w]) for w in w_ids]
+
+        return {
+            "positions": len(market),
+            "total_value": float(value.sum()),
+            "total_pnl": float(pnl.sum()),
+            "exposure": exposure,
+            "consensus": consensus,
+            "wallets": per_wallet,
+        }
+
+
+PORTFOLIO = PortfolioTable()
+
+
+def portfolio_wallets():
+    state = load_state()
+    wallets = [state["monitored_eoa"]] if state.get("monitored_eoa") else []
+    for w in state.get("followed_wallets", []):
+        if w.lower() not in (x.lower() for x in wallets):
+            wallets.append(w)
+    return wallets
+
+
+def refresh_portfolio(api_key, only_needed=False):
+    """Fetch lại positions các ví theo dõi; `only_needed` chỉ fetch ví chưa có/stale."""
+    for wallet in portfolio_wallets():
+        if only_needed and not PORTFOLIO.needs_refresh(wallet):
+            continue
+        try:
+            url = OPINION_POSITIONS_URL.format(wallet=wallet)
+            PORTFOLIO.update_wallet(wallet, opinion_get(api_key, url, Position))
+        except Exception as e:
+            print(f"refresh_portfolio error ({wallet}):", repr(e))
+
+
+def short_addr(addr):
+    return f"{addr[:6]}…{addr[-4:]}"
+
+
+def build_portfolio(api_key):
+    wallets = portfolio_wallets()
+    if not wallets:
+        return "Chưa theo dõi ví nào. Dùng /follow <EOA> hoặc monitor 1 ví."
+
+    refresh_portfolio(api_key, only_needed=True)
+    s = PORTFOLIO.summary(wallets)
+    if not s["positions"]:
+        return f"{len(wallets)} ví đang theo dõi không có position nào đang mở."
+
+    lines = [
+        f"*Portfolio* ({len(wallets)} ví, {s['positions']} vị thế)",
+        f"Tổng value: ${s['total_value']:.2f} | PnL: {fmt_signed(s['total_pnl'], '.2f', prefix='$')}",
+        "",
+        "*Exposure theo market*",
+    ]
+    for i, (title, value, yes, no, pnl, n) in enumerate(s["exposure"][:PORTFOLIO_TOP_MARKETS], 1):
+        lines.append(f"{i}. {title[:50]}")
+        lines.append(f"   ${value:.2f} (YES ${yes:.2f} / NO ${no:.2f}) | PnL: {fmt_signed(pnl, '.2f', prefix='$')} | {n} ví")
+
+    lines += ["", "*Consensus (≥2 ví cùng phía)*"]
+    for title, outcome, n, value, avg in s["consensus"][:PORTFOLIO_TOP_MARKETS]:
+        avg_str = fmt_num(None if np.isnan(avg) else avg, ".4f", suffix="c")
+        lines.append(f"- {title[:50]}: {outcome} — {n} ví, ${value:.2f}, avg {avg_str}")
+    if not s["consensus"]:
+        lines.append("(không có)")
+
+    lines += ["", "*Theo ví*"]
+    for wallet, value, pnl in s["wallets"]:
+        lines.append(f"- `{short_addr(wallet)}`: ${value:.2f} | PnL: {fmt_signed(pnl, '.2f', prefix='$')}")
+
+    return "\n".join(lines)
+
+
 # ============================================================
 # TELEGRAM HELPERS
 # ============================================================
@@ -191,6 +553,7 @@ def get_main_menu_markup(has_wallet=False):
                 [{"text": "Đổi ví đang monitor", "callback_data": "change_wallet"}],
                 [{"text": "View Positions",       "callback_data": "view_positions"}],
                 [{"text": "Trade History",         "callback_data": "view_history"}],
+                [{"text": "Portfolio",             "callback_data": "view_portfolio"}],
                 [{"text": "Copy Trade",            "callback_data": "copy_trade"}],
             ]
         }
@@ -200,6 +563,7 @@ def get_main_menu_markup(has_wallet=False):
                 [{"text": "Monitor Wallet", "callback_data": "monitor_wallet"}],
                 [{"text": "View Positions", "callback_data": "view_positions"}],
                 [{"text": "Trade History",  "callback_data": "view_history"}],
+                [{"text": "Portfolio",      "callback_data": "view_portfolio"}],
                 [{"text": "Copy Trade",     "callback_data": "copy_trade"}],
             ]
         }
@@ -244,63 +608,125 @@ def get_user_name(message):
     return (first + " " + last).strip() or "bạn"
 
 
+def parse_command(text):
+    """"/cmd@botname arg" -> ("/cmd", "arg"); group chat gửi kèm @botname."""
+    parts = text.split(maxsplit=1)
+    if not parts:
+        return "", ""
+    return parts[0].split("@", 1)[0], (parts[1].strip() if len(parts) > 1 else "")
+
+
 # ============================================================
 # STATE
 # ============================================================
 
+# state.json được ghi từ main thread, monitor thread và scheduler
+STATE_LOCK = threading.RLock()
+
+
+def write_json_atomic(path, data):
+    """Ghi ra file tạm rồi os.replace, thread khác không bao giờ đọc được file dở."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
 def load_state():
-    try:
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+    with STATE_LOCK:
+        try:
+            with open(STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
 
 
 def save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with STATE_LOCK:
+        write_json_atomic(STATE_FILE, state)
+
+
+def update_state(fn):
+    """Đọc-sửa-ghi state.json dưới STATE_LOCK; fn(state) sửa state tại chỗ."""
+    with STATE_LOCK:
+        state = load_state()
+        fn(state)
+        save_state(state)
+        return state
 
 
 # ============================================================
 # DAILY SUMMARY
 # ============================================================
 
+DAILY_LOCK = threading.Lock()
+
+
+def load_tz(name):
+    """ZoneInfo theo tên IANA, None (= giờ máy) nếu tên sai hoặc không có tzdata."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def tz_database_available():
+    # Windows không có tz database hệ thống, cần `pip install tzdata`
+    return load_tz("UTC") is not None
+
+
+def get_chat_tz_name(chat_id):
+    state = load_state()
+    return (state.get("timezones") or {}).get(str(chat_id)) or DEFAULT_TIMEZONE
+
+
+def get_chat_tz(chat_id):
+    return load_tz(get_chat_tz_name(chat_id))
+
+
 def load_daily():
-    today_str = str(date.today())
     try:
         with open(DAILY_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
-        if data.get("date") != today_str:
-            return {"date": today_str, "total": 0, "markets": []}
-        return data
     except Exception:
-        return {"date": today_str, "total": 0, "markets": []}
+        return {"days": {}}
+    # Format cũ: 1 ngày duy nhất {"date", "total", "markets"}
+    if "date" in data:
+        return {"days": {data["date"]: {"total": data.get("total", 0), "markets": data.get("markets", [])}}}
+    data.setdefault("days", {})
+    return data
 
 
 def save_daily(daily):
-    with open(DAILY_FILE, "w", encoding="utf-8") as f:
-        json.dump(daily, f, ensure_ascii=False, indent=2)
-
-
-def add_trade_to_daily(daily, trade):
-    today_str = str(date.today())
-    if daily.get("date") != today_str:
-        daily = {"date": today_str, "total": 0, "markets": []}
-    daily["total"] = int(daily.get("total", 0)) + 1
-    market = trade.get("rootMarketTitle") or trade.get("marketTitle") or "unknown"
-    if market not in daily["markets"]:
-        daily["markets"].append(market)
-    save_daily(daily)
-    return daily
-
-
-def build_daily_summary(wallet, daily):
-    d = daily.get("date", str(date.today()))
-    total = daily.get("total", 0)
-    markets = daily.get("markets", [])
+    write_json_atomic(DAILY_FILE, daily)
+
+
+def add_trade_to_daily(trade, chat_id):
+    tz = get_chat_tz(chat_id)
+    ts = trade.created_at or time.time()
+    day = str(datetime.fromtimestamp(ts, tz).date())
+    with DAILY_LOCK:
+        last_sent = (load_state().get("last_summary") or {}).get(str(chat_id))
+        if last_sent and day <= last_sent:
+            # Ngày đã gửi summary (trade tới trễ): tính vào hôm nay thay vì mở lại ngày cũ
+            today = str(datetime.now(tz).date())
+            print(f"Trade {trade.trade_id} ngày {day} đã gửi summary, tính vào {today}")
+            day = today
+        daily = load_daily()
+        bucket = daily["days"].setdefault(day, {"total": 0, "markets": []})
+        bucket["total"] = int(bucket.get("total", 0)) + 1
+        market = trade.title or "unknown"
+        if market not in bucket["markets"]:
+            bucket["markets"].append(market)
+        save_daily(daily)
+
+
+def build_daily_summary(wallet, day, bucket, markdown=True):
+    total = bucket.get("total", 0)
+    markets = bucket.get("markets", [])
     lines = [
-        f"*Daily Summary* ({d})",
-        f"Ví đang monitor: `{wallet}`",
+        f"*Daily Summary* ({day})" if markdown else f"Daily Summary ({day})",
+        f"Ví đang monitor: `{wallet}`" if markdown else f"Ví đang monitor: {wallet}",
         f"Tổng lệnh trade: {total}",
         "Markets đã traded:",
     ]
@@ -309,56 +735,101 @@ def build_daily_summary(wallet, daily):
     return "\n".join(lines)
 
 
-# ============================================================
-# TRADE POLLING
-# ============================================================
+def is_permanent_tg_error(resp):
+    """Lỗi 4xx (trừ 429) gửi lại cũng fail, vd 400 "can't parse entities"."""
+    code = resp.get("error_code")
+    return isinstance(code, int) and 400 <= code < 500 and code != 429
 
-def pick_id(trade):
-    for k in ["txHash", "tradeNo", "createdAt", "id"]:
-        v = trade.get(k)
-        if v:
-            return str(v)
-    return str(trade)
 
+def advance_last_summary(state, chat_key, day):
+    sent = state.setdefault("last_summary", {})
+    if sent.get(chat_key) is None or day > sent[chat_key]:
+        sent[chat_key] = day
 
-def fmt_outcome(side):
-    return "YES" if str(side) == "1" else "NO" if str(side) == "2" else str(side)
 
+def send_daily_summaries(token, chat_id):
+    """Gửi summary cho mọi ngày đã kết thúc (theo timezone của chat) mà chưa gửi.
 
-def format_trade_message(wallet, t):
-    side = str(t.get("side") or "").upper()
-    outcome = fmt_outcome(t.get("outcomeSide"))
+    Chạy lúc 00:00 mỗi ngày và 1 lần sau lần poll REST thành công đầu tiên
+    của MonitorThread (để trade lúc bot tắt đã vào daily) để bù các ngày bị
+    lỡ (kể cả ngày không có trade). Mỗi ngày chỉ bị xoá khỏi
+    daily_summary.json sau khi Telegram gửi thành công. Lỗi mạng / 429 thì
+    giữ lại và thử lại sau SUMMARY_RETRY_SECONDS; lỗi 4xx khác gửi lại dạng
+    plain text, vẫn lỗi thì bỏ qua ngày đó.
+    """
+    state = load_state()
+    wallet = state.get("monitored_eoa")
+    if not wallet:
+        return
 
-    root_market_title = t.get("rootMarketTitle") or t.get("marketTitle") or "?"
-    root_market_id = t.get("rootMarketId") or t.get("marketId") or ""
-    market_id = t.get("marketId") or ""
-    sub_market_title = t.get("marketTitle") or ""
+    chat_key = str(chat_id)
+    yesterday = datetime.now(get_chat_tz(chat_id)).date() - timedelta(days=1)
+    with DAILY_LOCK:
+        last_sent = (load_state().get("last_summary") or {}).get(chat_key)
+        days = dict(load_daily()["days"])
+
+    due = {d for d in days if d <= str(yesterday)}
+    if last_sent is not None:
+        d = date.fromisoformat(last_sent) + timedelta(days=1)
+        while d <= yesterday:
+            due.add(str(d))
+            d += timedelta(days=1)
+
+    for d in sorted(due):
+        bucket = days.get(d, {"total": 0, "markets": []})
+        resp = send_message(token, chat_id, build_daily_summary(wallet, d, bucket), parse_mode="Markdown")
+        if is_permanent_tg_error(resp):
+            # Tên market có _ * [ ... làm hỏng Markdown
+            resp = send_message(token, chat_id, build_daily_summary(wallet, d, bucket, markdown=False))
+        if is_permanent_tg_error(resp):
+            print(f"Daily summary for {d} skipped, Telegram rejected it:", resp)
+        elif not resp.get("ok"):
+            print(f"Daily summary for {d} failed, retry in {SUMMARY_RETRY_SECONDS}s:", resp)
+            schedule_daily_summary(token, chat_id, due=time.time() + SUMMARY_RETRY_SECONDS)
+            return
+        with DAILY_LOCK:
+            daily = load_daily()
+            daily["days"].pop(d, None)
+            save_daily(daily)
+            update_state(lambda state: advance_last_summary(state, chat_key, d))
+        if resp.get("ok"):
+            print(f"Daily summary sent for {d}")
+
+    with DAILY_LOCK:
+        update_state(lambda state: advance_last_summary(state, chat_key, str(yesterday)))
 
-    # Multi-market: rootMarketId khác marketId
-    is_multi = root_market_id and market_id and str(root_market_id) != str(market_id)
 
-    if root_market_id:
-        suffix = "&type=multi" if is_multi else ""
-        market_url = f"https://app.opinion.trade/detail?topicId={root_market_id}{suffix}"
+# ============================================================
+# TRADE POLLING
+# ============================================================
+
+def fmt_outcome(side):
+    return "YES" if side == "1" else "NO" if side == "2" else side
+
+
+def format_trade_message(wallet, t):
+    outcome = fmt_outcome(t.outcome_side)
+    root_market_title = t.title or "?"
+
+    if not t.title and t.tx_hash:
+        # Trade từ chain log: chưa có tên market
+        market_link = f"[{t.tx_hash[:10]}…](https://bscscan.com/tx/{t.tx_hash})"
+    elif t.root_market_id:
+        suffix = "&type=multi" if t.is_multi else ""
+        market_url = f"https://app.opinion.trade/detail?topicId={t.root_market_id}{suffix}"
         market_link = f"[{root_market_title}]({market_url})"
     else:
         market_link = root_market_title
 
     # Action: thêm outcome cụ thể nếu là multi
-    if is_multi and sub_market_title and sub_market_title != root_market_title:
-        action_str = f"*{side} {outcome} ({sub_market_title})*"
+    action = " ".join(x for x in (t.side, outcome) if x)
+    if t.sub_title:
+        action_str = f"*{action} ({t.sub_title})*"
     else:
-        action_str = f"*{side} {outcome}*"
+        action_str = f"*{action}*"
 
-    try:
-        price_str = f"{float(t.get('price') or 0) * 100:.1f} c"
-    except Exception:
-        price_str = "?"
-
-    try:
-        usd_str = f"${float(t.get('amount') or 0):.2f}"
-    except Exception:
-        usd_str = "?"
+    price_str = fmt_num(t.price, ".1f", scale=100, suffix=" c")
+    usd_str = fmt_num(t.amount, ".2f", prefix="$")
 
     lines = [
         "✅ *TRADE EXECUTED*",
@@ -374,95 +845,424 @@ def format_trade_message(wallet, t):
 
 def fetch_trades(api_key, wallet):
     url = OPINION_TRADE_URL.format(wallet=wallet)
-    headers = {"apikey": api_key}
     last_err = None
     for _ in range(3):
         try:
-            resp = requests.get(url, headers=headers, timeout=45)
-            resp.raise_for_status()
-            data = resp.json()
-            result = data.get("result", {})
-            return result.get("list") or []
+            return opinion_get(api_key, url, Trade, timeout=45)
         except Exception as e:
             last_err = e
             time.sleep(2)
     raise last_err
 
 
+# ============================================================
+# TRADE SOURCES
+# ============================================================
+
+class TradeSource:
+    """Nguồn phát hiện trade mới của 1 ví cho MonitorThread.
+
+    `poll()` trả về các trade mới (cũ → mới) kể từ lần poll trước;
+    MonitorThread gọi lại sau mỗi `interval` giây. `has_market_info` = trade
+    có tên market, được tính vào daily summary.
+    """
+
+    name = "source"
+    interval = POLL_SECONDS
+    has_market_info = True
+
+    def poll(self):
+        raise NotImplementedError
+
+    def on_other_trade(self, tr):
+        """Trade do source khác phát hiện, gọi từ thread của MonitorThread."""
+
+
+class RestTradeSource(TradeSource):
+    """Poll /trade/user/{wallet}, so sánh với last_seen_id lưu trong state.json."""
+
+    name = "rest"
+    interval = POLL_SECONDS
+
+    def __init__(self, api_key, wallet):
+        self.api_key = api_key
+        self.wallet = wallet
+        self.last_seen_id = load_state().get("last_seen_id")
+
+    def save_last_seen(self, trade_id):
+        self.last_seen_id = trade_id
+        update_state(lambda state: state.update(last_seen_id=trade_id))
+
+    def poll(self):
+        trades = fetch_trades(self.api_key, self.wallet)
+        if not trades:
+            return []
+        if self.last_seen_id is None:
+            self.save_last_seen(trades[0].trade_id)
+            return []
+
+        new_trades = []
+        for tr in trades:
+            if tr.trade_id == self.last_seen_id:
+                break
+            new_trades.append(tr)
+        if new_trades:
+            self.save_last_seen(trades[0].trade_id)
+        return new_trades[::-1]
+
+
+def rpc_call(url, method, params):
+    body = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+    resp = requests.post(url, json=body, timeout=10)
+    resp.raise_for_status()
+    data = decode_json(resp)
+    if data.get("error"):
+        raise RuntimeError(f"{method}: {data['error']}")
+    return data.get("result")
+
+
+def address_topic(address):
+    return "0x" + address.lower().removeprefix("0x").rjust(64, "0")
+
+
+def decode_order_filled(log):
+    """OrderFilled log -> (side, token_id, usd, shares) nhìn từ phía maker.
+
+    data = makerAssetId, takerAssetId, makerAmountFilled, takerAmountFilled, fee;
+    assetId 0 là collateral (USDT).
+    """
+    data = log["data"].removeprefix("0x")
+    maker_asset, taker_asset, maker_amount, taker_amount = (
+        int(data[i * 64:(i + 1) * 64], 16) for i in range(4)
+    )
+    scale = 10 ** CHAIN_AMOUNT_DECIMALS
+    if maker_asset == 0:
+        return "BUY", taker_asset, maker_amount / scale, taker_amount / scale
+    return "SELL", maker_asset, taker_amount / scale, maker_amount / scale
+
+
+class ChainLogTradeSource(TradeSource):
+    """Theo dõi event OrderFilled của exchange contract trên BSC qua JSON-RPC.
+
+    Log chỉ có token id, không có tên market, nên trade từ nguồn này có
+    title rỗng (alert link tới tx); REST source bổ sung sau (cùng txHash)
+    cho daily summary.
+
+    User trade qua Safe proxy nên maker on-chain là proxy, không phải EOA.
+    Proxy lấy từ state.json `proxy_wallets[eoa]` (sửa tay được); chưa có thì
+    khi REST báo 1 tx mà chain không thấy, tìm trong receipt của tx đó maker
+    nào là Safe có EOA làm owner (`isOwner`) rồi lưu lại.
+    """
+
+    name = "chain"
+    interval = CHAIN_POLL_SECONDS
+    has_market_info = False
+
+    def __init__(self, rpc_url, contract, wallet):
+        self.rpc_url = rpc_url
+        self.contract = contract
+        self.wallet = wallet
+        self.trader = (load_state().get("proxy_wallets") or {}).get(wallet.lower()) or wallet
+        self.next_block = None
+        self.started_at = time.time()
+        # txHash đã thấy / đã kiểm tra
+        self.seen_tx = OrderedDict()
+
+    def get_logs(self, from_block, to_block, topics):
+        return rpc_call(self.rpc_url, "eth_getLogs", [{
+            "address": self.contract,
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+            "topics": topics,
+        }]) or []
+
+    def poll(self):
+        latest = int(rpc_call(self.rpc_url, "eth_blockNumber", []), 16)
+        if self.next_block is None:
+            self.next_block = latest + 1
+            return []
+        if latest < self.next_block:
+            return []
+
+        to_block = min(latest, self.next_block + CHAIN_MAX_BLOCK_RANGE - 1)
+        # Mọi order ví fill (kể cả khi là taker của match) đều emit 1 event
+        # với ví (proxy) là maker (topic 2); event có ví ở topic 3 là fill
+        # của order đối ứng, lấy thêm sẽ tính trùng.
+        logs = self.get_logs(self.next_block, to_block,
+            [ORDER_FILLED_TOPIC, None, address_topic(self.trader)])
+        self.next_block = to_block + 1
+
+        logs.sort(key=lambda lg: (int(lg["blockNumber"], 16), int(lg["logIndex"], 16)))
+        # Gộp các fill cùng tx + cùng side + cùng token
+        fills = {}
+        for lg in logs:
+            if lg.get("removed"):
+                continue
+            side, token_id, usd, shares = decode_order_filled(lg)
+            remember(self.seen_tx, lg["transactionHash"].lower())
+            key = (lg["transactionHash"], side, token_id)
+            prev_usd, prev_shares = fills.get(key, (0, 0))
+            fills[key] = (prev_usd + usd, prev_shares + shares)
+
+        return [
+            Trade(
+                trade_id=f"{tx_hash}:{side}:{token_id}",
+                tx_hash=tx_hash,
+                side=side,
+                price=usd / shares if shares else None,
+                amount=usd,
+                created_at=int(time.time()),
+            )
+            for (tx_hash, side, token_id), (usd, shares) in fills.items()
+        ]
+
+
+    def is_safe_owner(self, safe):
+        data = SAFE_IS_OWNER_SELECTOR + address_topic(self.wallet)[2:]
+        try:
+            result = rpc_call(self.rpc_url, "eth_call", [{"to": safe, "data": data}, "latest"])
+            return int(result, 16) == 1
+        except Exception:
+            # Không phải contract / không có isOwner
+            return False
+
+    def on_other_trade(self, tr):
+        tx = tr.tx_hash.lower()
+        if not tx or tx in self.seen_tx or (tr.created_at or 0) < self.started_at:
+            return
+        remember(self.seen_tx, tx)
+
+        receipt = rpc_call(self.rpc_url, "eth_getTransactionReceipt", [tr.tx_hash]) or {}
+        makers = {
+            "0x" + lg["topics"][2][-40:].lower()
+            for lg in receipt.get("logs", [])
+            if lg.get("address", "").lower() == self.contract.lower()
+            and lg["topics"][:1] == [ORDER_FILLED_TOPIC] and len(lg["topics"]) > 2
+        }
+        if self.trader.lower() in makers:
+            return  # chain chỉ chậm hơn REST
+
+        print(f"WARNING: chain source không thấy fill của {self.trader} trong tx {tr.tx_hash} (REST có)")
+        for maker in sorted(makers):
+            if self.is_safe_owner(maker):
+                self.trader = maker
+                update_state(lambda state: state.setdefault("proxy_wallets", {}).update({self.wallet.lower(): maker}))
+                print(f"Chain source: {self.wallet} trade qua proxy {maker}")
+                return
+
+
+def make_trade_sources(api_key, wallet):
+    sources = [RestTradeSource(api_key, wallet)]
+    rpc_url = os.getenv("BSC_RPC_URL")
+    contract = os.getenv("OPINION_EXCHANGE_CONTRACT")
+    if rpc_url and contract:
+        sources.append(ChainLogTradeSource(rpc_url, contract, wallet))
+    return sources
+
+
 # ============================================================
 # MONITOR THREAD
 # ============================================================
 
+def remember(seen, key):
+    seen[key] = True
+    if len(seen) > SEEN_TX_LIMIT:
+        seen.popitem(last=False)
+
+
 class MonitorThread(threading.Thread):
-    def __init__(self, token, chat_id, api_key, wallet):
+    def __init__(self, token, chat_id, api_key, wallet, sources=None):
         super().__init__(daemon=True)
         self.token = token
         self.chat_id = chat_id
         self.api_key = api_key
         self.wallet = wallet
+        self.sources = sources if sources is not None else make_trade_sources(api_key, wallet)
         self.stop_event = threading.Event()
-
-        state = load_state()
-        self.last_seen_id = state.get("last_seen_id")
-        self.daily = load_daily()
-        self.last_heartbeat = 0
+        self.trades = queue.Queue()
+        # source name -> txHash đã xử lý
+        self.seen_tx = {}
+        self.caught_up = False
 
     def stop(self):
         self.stop_event.set()
 
-    def run(self):
-        print(f"Monitor started: {self.wallet}")
+    def handle_trade(self, src, tr):
+        """Gộp trade từ mọi source.
+
+        Mỗi source tự lọc trade mới (REST theo last_seen_id, chain theo block),
+        nên nhiều fill cùng tx từ 1 source vẫn alert đủ. Giữa các source dedup
+        theo txHash: tx đã alert từ source khác thì không alert lại, nhưng bản
+        REST vẫn được tính vào daily summary.
+        """
+        tx = tr.tx_hash.lower()
+        alerted = bool(tx) and any(tx in seen for name, seen in self.seen_tx.items() if name != src.name)
+        if tx:
+            remember(self.seen_tx.setdefault(src.name, OrderedDict()), tx)
+
+        if not alerted:
+            send_message(
+                self.token, self.chat_id,
+                format_trade_message(self.wallet, tr),
+                parse_mode="Markdown"
+            )
+            PORTFOLIO.mark_stale(self.wallet)
+        if src.has_market_info:
+            add_trade_to_daily(tr, self.chat_id)
+
+        for other in self.sources:
+            if other is not src:
+                try:
+                    other.on_other_trade(tr)
+                except Exception as e:
+                    print(f"{other.name} on_other_trade error:", repr(e))
+
+    def poll_source(self, src):
         consecutive_errors = 0
-
         while not self.stop_event.is_set():
             try:
-                now_ts = time.time()
-                if now_ts - self.last_heartbeat >= HEARTBEAT_SECONDS:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Monitor alive: {self.wallet}")
-                    self.last_heartbeat = now_ts
-
-                trades = fetch_trades(self.api_key, self.wallet)
+                for tr in src.poll():
+                    self.trades.put((src, tr))
                 consecutive_errors = 0
-
-                if isinstance(trades, list) and len(trades) > 0:
-                    if self.last_seen_id is None:
-                        self.last_seen_id = pick_id(trades[0])
-                        state = load_state()
-                        state["last_seen_id"] = self.last_seen_id
-                        save_state(state)
-                    else:
-                        new_trades = []
-                        for tr in trades:
-                            if pick_id(tr) == self.last_seen_id:
-                                break
-                            new_trades.append(tr)
-
-                        for tr in reversed(new_trades):
-                            send_message(
-                                self.token, self.chat_id,
-                                format_trade_message(self.wallet, tr),
-                                parse_mode="Markdown"
-                            )
-                            self.daily = add_trade_to_daily(self.daily, tr)
-
-                        if new_trades:
-                            self.last_seen_id = pick_id(trades[0])
-                            state = load_state()
-                            state["last_seen_id"] = self.last_seen_id
-                            save_state(state)
-
+                if src.has_market_info and not self.caught_up:
+                    # Mốc: trade lúc bot tắt đã nằm trong queue trước nó
+                    self.caught_up = True
+                    self.trades.put((src, None))
             except Exception as e:
-                print("Poll error:", repr(e))
+                print(f"Poll error ({src.name}):", repr(e))
                 consecutive_errors += 1
                 if consecutive_errors == 10:
                     send_message(self.token, self.chat_id,
-                        f"Bot lỗi liên tục 10 lần!\nLỗi cuối: {repr(e)}")
+                        f"Bot lỗi liên tục 10 lần ({src.name})!\nLỗi cuối: {repr(e)}")
+
+            self.stop_event.wait(src.interval)
+
+    def run(self):
+        print(f"Monitor started: {self.wallet} ({', '.join(s.name for s in self.sources)})")
+        for src in self.sources:
+            threading.Thread(target=self.poll_source, args=(src,), daemon=True).start()
 
-            self.stop_event.wait(POLL_SECONDS)
+        while not self.stop_event.is_set():
+            try:
+                src, tr = self.trades.get(timeout=1)
+            except queue.Empty:
+                continue
+            if tr is None:
+                # Đã xử lý hết trade lúc bot tắt -> bù daily summary bị lỡ
+                schedule_daily_summary(self.token, self.chat_id, due=time.time())
+                continue
+            self.handle_trade(src, tr)
 
         print(f"Monitor stopped: {self.wallet}")
 
 
+# ============================================================
+# SCHEDULER
+# ============================================================
+
+class Job:
+    __slots__ = ("name", "func", "next_run", "due")
+
+    def __init__(self, name, func, next_run, due):
+        self.name = name
+        self.func = func
+        self.next_run = next_run
+        self.due = due
+
+
+class Scheduler(threading.Thread):
+    """Heap các job định kỳ, chạy trên 1 thread riêng, không phụ thuộc vòng getUpdates.
+
+    `next_run(now)` trả về timestamp lần chạy kế tiếp. Job cùng tên thay thế
+    job cũ; entry cũ trong heap bị bỏ qua khi tới lượt.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.cond = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.seq = itertools.count()
+
+    def add(self, name, func, next_run, due=None):
+        job = Job(name, func, next_run, time.time() if due is None else due)
+        with self.cond:
+            self.jobs[name] = job
+            heapq.heappush(self.heap, (job.due, next(self.seq), job))
+            self.cond.notify()
+
+    def cancel(self, name):
+        with self.cond:
+            self.jobs.pop(name, None)
+
+    def _next_due_job(self):
+        with self.cond:
+            while True:
+                while self.heap and self.jobs.get(self.heap[0][2].name) is not self.heap[0][2]:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self.heap)[2]
+                # Ngủ tối đa SCHEDULER_MAX_SLEEP để bắt kịp khi đồng hồ máy nhảy (sleep/hibernate)
+                self.cond.wait(min(delay, SCHEDULER_MAX_SLEEP))
+
+    def run(self):
+        while True:
+            job = self._next_due_job()
+            try:
+                job.func()
+            except Exception as e:
+                print(f"Scheduler job {job.name} error:", repr(e))
+            with self.cond:
+                if self.jobs.get(job.name) is job:
+                    job.due = job.next_run(time.time())
+                    heapq.heappush(self.heap, (job.due, next(self.seq), job))
+
+
+def every(seconds):
+    return lambda now: now + seconds
+
+
+def daily_at(chat_id, hour=0, minute=0):
+    """Lần kế tiếp hour:minute theo timezone hiện tại của chat."""
+    def next_run(now):
+        local = datetime.fromtimestamp(now, get_chat_tz(chat_id))
+        target = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if target <= local:
+            target += timedelta(days=1)
+        return target.timestamp()
+    return next_run
+
+
+def heartbeat():
+    if monitor_thread and monitor_thread.is_alive():
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Monitor alive: {monitor_thread.wallet}")
+
+
+def expire_chat_steps():
+    cutoff = time.time() - CHAT_STEP_TTL
+    for chat_id, entry in list(CHAT_STATE.items()):
+        if entry.get("ts", 0) < cutoff:
+            CHAT_STATE.pop(chat_id, None)
+
+
+def schedule_daily_summary(token, chat_id, due=None):
+    """Đặt job summary của chat; mặc định chạy lần đầu lúc 00:00 kế tiếp."""
+    chat_id = str(chat_id)
+    next_run = daily_at(chat_id)
+    scheduler.add(f"daily_summary:{chat_id}",
+        lambda: send_daily_summaries(token, chat_id),
+        next_run, due=next_run(time.time()) if due is None else due)
+
+
+scheduler = Scheduler()
+scheduler.add("heartbeat", heartbeat, every(HEARTBEAT_SECONDS))
+scheduler.add("expire_chat_steps", expire_chat_steps, every(CACHE_EXPIRY_SECONDS))
+
+
 # ============================================================
 # BOT STATE
 # ============================================================
@@ -476,7 +1276,7 @@ def get_chat_step(chat_id):
 
 
 def set_chat_step(chat_id, step):
-    CHAT_STATE[str(chat_id)] = {"step": step}
+    CHAT_STATE[str(chat_id)] = {"step": step, "ts": time.time()}
 
 
 def clear_chat_step(chat_id):
@@ -485,11 +1285,12 @@ def clear_chat_step(chat_id):
 
 def start_monitoring(token, chat_id, api_key, eoa):
     global monitor_thread
-    state = load_state()
-    state["last_seen_id"] = None
-    state["monitored_eoa"] = eoa
-    state["chat_id"] = str(chat_id)
-    save_state(state)
+    with STATE_LOCK:
+        old_chat_id = load_state().get("chat_id")
+        update_state(lambda state: state.update(last_seen_id=None, monitored_eoa=eoa, chat_id=str(chat_id)))
+
+    if old_chat_id and old_chat_id != str(chat_id):
+        scheduler.cancel(f"daily_summary:{old_chat_id}")
 
     if monitor_thread and monitor_thread.is_alive():
         monitor_thread.stop()
@@ -497,6 +1298,7 @@ def start_monitoring(token, chat_id, api_key, eoa):
 
     monitor_thread = MonitorThread(token, chat_id, api_key, eoa)
     monitor_thread.start()
+    schedule_daily_summary(token, chat_id)
 
     send_message(token, chat_id,
         f"Bắt đầu monitor ví:\n`{eoa}`",
@@ -541,6 +1343,66 @@ def handle_message(token, api_key, message):
                 reply_markup={"inline_keyboard": [[{"text": "Menu chính", "callback_data": "main_menu"}]]})
         return
 
+    cmd, arg = parse_command(text)
+
+    if cmd == "/portfolio":
+        send_message(token, chat_id, build_portfolio(api_key), parse_mode="Markdown",
+            reply_markup={"inline_keyboard": [[{"text": "Menu chính", "callback_data": "main_menu"}]]})
+        return
+
+    if cmd in ("/follow", "/unfollow"):
+        wallet = arg
+        state = load_state()
+        followed = state.get("followed_wallets", [])
+        if not wallet:
+            listed = "\n".join(f"`{w}`" for w in followed) or "(chưa có)"
+            send_message(token, chat_id,
+                f"Ví đang follow cho /portfolio:\n{listed}\n\nThêm: `/follow <EOA>`\nBỏ: `/unfollow <EOA>`",
+                parse_mode="Markdown")
+            return
+        if not (wallet.startswith("0x") and len(wallet) == 42):
+            send_message(token, chat_id, f"Địa chỉ ví không hợp lệ: {wallet}")
+            return
+
+        def apply(state):
+            followed = [w for w in state.get("followed_wallets", []) if w.lower() != wallet.lower()]
+            if cmd == "/follow":
+                followed.append(wallet)
+            state["followed_wallets"] = followed
+
+        state = update_state(apply)
+        if cmd == "/follow":
+            msg = f"Đã follow ví:\n`{wallet}`"
+        else:
+            if wallet.lower() != (state.get("monitored_eoa") or "").lower():
+                PORTFOLIO.remove_wallet(wallet)
+            msg = f"Đã bỏ follow ví:\n`{wallet}`"
+        send_message(token, chat_id, msg, parse_mode="Markdown")
+        return
+
+    if cmd == "/timezone":
+        if not arg:
+            send_message(token, chat_id,
+                f"Timezone hiện tại: `{get_chat_tz_name(chat_id)}`\n\nĐổi bằng: `/timezone Asia/Ho_Chi_Minh`",
+                parse_mode="Markdown")
+            return
+        tz_name = arg
+        if not tz_database_available():
+            send_message(token, chat_id,
+                "Máy chạy bot chưa có timezone database (cài `pip install tzdata`), đang dùng giờ máy.",
+                parse_mode="Markdown")
+            return
+        if load_tz(tz_name) is None:
+            send_message(token, chat_id, f"Timezone không hợp lệ: {tz_name}")
+            return
+        state = update_state(lambda state: state.setdefault("timezones", {}).update({str(chat_id): tz_name}))
+        if state.get("chat_id") == str(chat_id):
+            schedule_daily_summary(token, chat_id)
+        send_message(token, chat_id,
+            f"Đã đặt timezone: `{tz_name}`\nDaily summary sẽ gửi lúc 00:00 theo giờ này.",
+            parse_mode="Markdown")
+        return
+
     step = get_chat_step(chat_id)
 
     if step == "waiting_eoa":
@@ -640,6 +1502,13 @@ def handle_callback(token, api_key, callback_query):
                 reply_markup={"inline_keyboard": [[{"text": "Menu chính", "callback_data": "main_menu"}]]})
         return
 
+    if data == "view_portfolio":
+        edit_message(token, chat_id, message_id, "Đang tổng hợp portfolio...")
+        edit_message(token, chat_id, message_id, build_portfolio(api_key),
+            reply_markup={"inline_keyboard": [[{"text": "Menu chính", "callback_data": "main_menu"}]]},
+            parse_mode="Markdown")
+        return
+
     if data.startswith("confirm_change:"):
         new_eoa = data.split("confirm_change:")[1]
         clear_chat_step(chat_id)
@@ -664,15 +1533,22 @@ def handle_callback(token, api_key, callback_query):
 def run_bot(token, api_key):
     print("Bot started, polling Telegram updates...")
     offset = 0
-    last_summary_date = None
+
+    if load_tz(DEFAULT_TIMEZONE) is None:
+        print(f"WARNING: không load được timezone {DEFAULT_TIMEZONE} "
+              "(thiếu tzdata? `pip install tzdata`), daily summary dùng giờ máy.")
 
     state = load_state()
     saved_eoa = state.get("monitored_eoa")
     if saved_eoa:
         print(f"Auto-resume monitor: {saved_eoa}")
         global monitor_thread
-        monitor_thread = MonitorThread(token, TELEGRAM_CHAT_ID, api_key, saved_eoa)
+        chat_id = state.get("chat_id") or TELEGRAM_CHAT_ID
+        monitor_thread = MonitorThread(token, chat_id, api_key, saved_eoa)
         monitor_thread.start()
+        schedule_daily_summary(token, chat_id)
+    scheduler.add("portfolio_refresh", lambda: refresh_portfolio(api_key), every(PORTFOLIO_REFRESH_SECONDS))
+    scheduler.start()
 
     processed_ids = set()
     while True:
@@ -697,19 +1573,6 @@ def run_bot(token, api_key):
                 elif "callback_query" in update:
                     handle_callback(token, api_key, update["callback_query"])
 
-            # Daily summary 23:58
-            now = datetime.now()
-            today_str = str(date.today())
-            if now.hour == 23 and now.minute >= 58 and last_summary_date != today_str:
-                if monitor_thread and monitor_thread.is_alive():
-                    daily = load_daily()
-                    send_message(token, TELEGRAM_CHAT_ID,
-                        build_daily_summary(monitor_thread.wallet, daily),
-                        parse_mode="Markdown")
-                    save_daily({"date": today_str, "total": 0, "markets": []})
-                    last_summary_date = today_str
-                    print(f"Daily summary sent for {today_str}")
-
         except Exception as e:
             print("Update loop error:", repr(e))
             time.sleep(5)
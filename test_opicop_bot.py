@@ -0,0 +1,283 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import opicop_bot as bot
+
+WALLET = "0x" + "ab" * 20
+PROXY = "0x" + "5a" * 20
+OTHER = "0x" + "cd" * 20
+CONTRACT = "0x" + "ee" * 20
+TOKEN_ID = 77
+UNIT = 10 ** bot.CHAIN_AMOUNT_DECIMALS
+
+
+def word(n):
+    return hex(n)[2:].rjust(64, "0")
+
+
+def order_filled(block, index, tx_hash, maker, taker, maker_asset, taker_asset, maker_amount, taker_amount):
+    return {
+        "address": CONTRACT,
+        "blockNumber": hex(block),
+        "logIndex": hex(index),
+        "transactionHash": tx_hash,
+        "removed": False,
+        "topics": [bot.ORDER_FILLED_TOPIC, "0x" + "0" * 64, bot.address_topic(maker), bot.address_topic(taker)],
+        "data": "0x" + "".join(word(x) for x in (maker_asset, taker_asset, maker_amount, taker_amount, 0)),
+    }
+
+
+class FakeNode:
+    """JSON-RPC node giả: eth_blockNumber, eth_getLogs có filter topics,
+    eth_getTransactionReceipt và eth_call isOwner của Safe."""
+
+    def __init__(self):
+        self.head = 100
+        self.logs = []
+        self.safe_owners = {}
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                method, params = req["method"], req["params"]
+                if method == "eth_blockNumber":
+                    result = hex(node.head)
+                elif method == "eth_getTransactionReceipt":
+                    result = {"logs": [lg for lg in node.logs if lg["transactionHash"] == params[0]]}
+                elif method == "eth_call":
+                    result = node.is_owner(params[0])
+                else:
+                    result = node.get_logs(params[0])
+                body = json.dumps({"jsonrpc": "2.0", "id": req["id"], "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def is_owner(self, call):
+        assert call["data"].startswith(bot.SAFE_IS_OWNER_SELECTOR)
+        owner = "0x" + call["data"][-40:]
+        if call["to"] not in self.safe_owners:
+            return "0x"
+        return "0x" + word(int(self.safe_owners[call["to"]] == owner))
+
+    def get_logs(self, flt):
+        lo, hi = int(flt["fromBlock"], 16), int(flt["toBlock"], 16)
+        return [
+            lg for lg in self.logs
+            if lg["address"] == flt["address"]
+            and lo <= int(lg["blockNumber"], 16) <= hi
+            and all(t is None or lg["topics"][i] == t for i, t in enumerate(flt["topics"]))
+        ]
+
+
+@pytest.fixture(autouse=True)
+def isolated_files(tmp_path, monkeypatch):
+    # state.json / daily_summary.json ghi vào thư mục tạm
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def node():
+    node = FakeNode()
+    threading.Thread(target=node.server.serve_forever, daemon=True).start()
+    yield node
+    node.server.shutdown()
+
+
+@pytest.fixture
+def source(node):
+    src = bot.ChainLogTradeSource(node.url, CONTRACT, WALLET)
+    assert src.poll() == []
+    return src
+
+
+def test_chain_source_taker_buy_not_double_counted(node, source):
+    # Ví là taker mua 100 shares với $60, khớp với 2 order của maker khác:
+    # 1 event của order ví (ví là maker) + 2 event fill của maker (ví ở topic taker)
+    node.logs = [
+        order_filled(101, 0, "0xaaa", OTHER, WALLET, TOKEN_ID, 0, 40 * UNIT, 24 * UNIT),
+        order_filled(101, 1, "0xaaa", OTHER, WALLET, TOKEN_ID, 0, 60 * UNIT, 36 * UNIT),
+        order_filled(101, 2, "0xaaa", WALLET, CONTRACT, 0, TOKEN_ID, 60 * UNIT, 100 * UNIT),
+    ]
+    node.head = 101
+
+    trades = source.poll()
+
+    assert len(trades) == 1
+    assert trades[0].tx_hash == "0xaaa"
+    assert trades[0].side == "BUY"
+    assert trades[0].amount == pytest.approx(60)
+    assert trades[0].price == pytest.approx(0.6)
+
+
+def test_chain_source_maker_sell_and_mixed_sides(node, source):
+    node.logs = [
+        order_filled(102, 0, "0xbbb", WALLET, OTHER, TOKEN_ID, 0, 10 * UNIT, 4 * UNIT),
+        order_filled(102, 1, "0xbbb", WALLET, OTHER, 0, TOKEN_ID + 1, 3 * UNIT, 5 * UNIT),
+    ]
+    node.head = 102
+
+    trades = {t.side: t for t in source.poll()}
+
+    assert set(trades) == {"BUY", "SELL"}
+    assert trades["SELL"].amount == pytest.approx(4)
+    assert trades["SELL"].price == pytest.approx(0.4)
+    assert trades["BUY"].amount == pytest.approx(3)
+    assert trades["BUY"].price == pytest.approx(0.6)
+    assert source.poll() == []
+
+
+class StaticSource(bot.TradeSource):
+    def __init__(self, name, has_market_info):
+        self.name = name
+        self.has_market_info = has_market_info
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    sent, daily = [], []
+    monkeypatch.setattr(bot, "send_message", lambda token, chat_id, text, **kw: sent.append(text))
+    monkeypatch.setattr(bot, "add_trade_to_daily", lambda tr, chat_id: daily.append(tr.trade_id))
+    m = bot.MonitorThread("token", "1", "key", WALLET, sources=[])
+    return m, sent, daily
+
+
+def rest_trade(trade_id, tx_hash, created_at=0):
+    return bot.Trade.from_dict({
+        "txHash": tx_hash, "tradeNo": trade_id, "side": "Buy", "outcomeSide": 1,
+        "marketId": 1, "rootMarketTitle": "M", "price": "0.5", "amount": "5",
+        "createdAt": created_at,
+    })
+
+
+def test_handle_trade_dedups_chain_and_rest_by_tx_hash(monitor):
+    m, sent, daily = monitor
+    chain, rest = StaticSource("chain", False), StaticSource("rest", True)
+
+    m.handle_trade(chain, bot.Trade("0xAAA:BUY:77", tx_hash="0xAAA", side="BUY", amount=5.0, price=0.5))
+    m.handle_trade(rest, rest_trade("0xaaa", "0xaaa"))
+
+    assert len(sent) == 1
+    assert daily == ["0xaaa"]
+
+
+def test_handle_trade_keeps_rest_fills_in_same_tx(monitor):
+    m, sent, daily = monitor
+    rest = StaticSource("rest", True)
+
+    m.handle_trade(rest, rest_trade("t1", "0xccc"))
+    m.handle_trade(rest, rest_trade("t2", "0xccc"))
+
+    assert len(sent) == 2
+    assert len(daily) == 2
+
+
+WALLET_A = "0x" + "a1" * 20
+WALLET_B = "0x" + "b2" * 20
+WALLET_C = "0x" + "c3" * 20
+
+
+def position(market_id, title, side, shares, value, avg_price, pnl):
+    return bot.Position.from_dict({
+        "marketId": market_id, "rootMarketTitle": title, "outcomeSide": side,
+        "sharesOwned": shares, "currentValueInQuoteToken": value,
+        "avgEntryPrice": avg_price, "unrealizedPnl": pnl,
+    })
+
+
+@pytest.fixture
+def portfolio():
+    table = bot.PortfolioTable()
+    table.update_wallet(WALLET_A, [
+        position(1, "BTC", 1, 10, 6, 0.5, 1),
+        position(2, "ETH", 2, 4, 2, 0.4, -0.5),
+    ])
+    table.update_wallet(WALLET_B, [
+        position(1, "BTC", 1, 20, 12, 0.6, "n/a"),  # pnl NaN
+        position(2, "ETH", "", 1, 1, 0.5, 0),       # side không rõ
+    ])
+    table.update_wallet(WALLET_C, [
+        position(1, "BTC", 2, 5, 2, 0.4, 0),
+        position(2, "ETH", 2, 6, 3, 0.5, 0.2),
+    ])
+    return table
+
+
+def test_portfolio_summary_aggregates(portfolio):
+    s = portfolio.summary()
+
+    assert s["positions"] == 6
+    assert s["total_value"] == pytest.approx(26)
+    assert s["total_pnl"] == pytest.approx(0.7)
+
+    (t1, v1, yes1, no1, pnl1, n1), (t2, v2, yes2, no2, pnl2, n2) = s["exposure"]
+    assert (t1, n1, t2, n2) == ("BTC", 3, "ETH", 3)
+    assert (v1, yes1, no1, pnl1) == pytest.approx((20, 18, 2, 1))
+    # Side không rõ chỉ tính vào tổng value, không tính là NO
+    assert (v2, yes2, no2, pnl2) == pytest.approx((6, 0, 5, -0.3))
+
+    assert [(c[0], c[1], c[2]) for c in s["consensus"]] == [("BTC", "YES", 2), ("ETH", "NO", 2)]
+    assert s["consensus"][0][3] == pytest.approx(18)
+    assert s["consensus"][0][4] == pytest.approx((0.5 * 10 + 0.6 * 20) / 30)
+    assert s["consensus"][1][4] == pytest.approx((0.4 * 4 + 0.5 * 6) / 10)
+
+    per_wallet = {w: (value, pnl) for w, value, pnl in s["wallets"]}
+    assert per_wallet[WALLET_B] == pytest.approx((13, 0))
+
+
+def test_portfolio_filters_wallets_and_skips_unchanged(portfolio):
+    s = portfolio.summary([WALLET_A, WALLET_C])
+
+    assert s["positions"] == 4
+    assert [(e[0], e[5]) for e in s["exposure"]] == [("BTC", 2), ("ETH", 2)]
+    assert [(c[0], c[1], c[2]) for c in s["consensus"]] == [("ETH", "NO", 2)]
+
+    assert portfolio.update_wallet(WALLET_C, [
+        position(1, "BTC", 2, 5, 2, 0.4, 0),
+        position(2, "ETH", 2, 6, 3, 0.5, 0.2),
+    ]) is False
+    assert portfolio.update_wallet(WALLET_C, []) is True
+    assert portfolio.summary()["positions"] == 4
+
+
+def test_chain_source_filters_on_saved_safe_proxy(node):
+    # User trade qua Safe proxy: maker on-chain là proxy, không phải EOA
+    bot.save_state({"proxy_wallets": {WALLET: PROXY}})
+    source = bot.ChainLogTradeSource(node.url, CONTRACT, WALLET)
+    assert source.poll() == []
+    node.logs = [order_filled(101, 0, "0xddd", PROXY, OTHER, 0, TOKEN_ID, 6 * UNIT, 10 * UNIT)]
+    node.head = 101
+
+    trades = source.poll()
+
+    assert [(t.tx_hash, t.side) for t in trades] == [("0xddd", "BUY")]
+    assert trades[0].amount == pytest.approx(6)
+
+
+def test_chain_source_resolves_proxy_from_rest_trade(node, source, monitor):
+    m, sent, daily = monitor
+    rest = StaticSource("rest", True)
+    m.sources = [rest, source]
+    node.safe_owners = {PROXY: WALLET, OTHER: OTHER}
+    node.logs = [order_filled(101, 0, "0xddd", PROXY, OTHER, 0, TOKEN_ID, 6 * UNIT, 10 * UNIT)]
+    node.head = 101
+    assert source.poll() == []
+
+    m.handle_trade(rest, rest_trade("0xddd", "0xddd", created_at=int(source.started_at) + 1))
+
+    assert source.trader == PROXY
+    assert bot.load_state()["proxy_wallets"] == {WALLET: PROXY}
+    node.logs.append(order_filled(102, 0, "0xeee", PROXY, OTHER, TOKEN_ID, 0, 10 * UNIT, 7 * UNIT))
+    node.head = 102
+    assert [(t.tx_hash, t.side) for t in source.poll()] == [("0xeee", "SELL")]